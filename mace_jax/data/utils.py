@@ -208,6 +208,8 @@ class AtomicNumberTable:
 
 
 def get_atomic_number_table_from_zs(zs: Iterable[int]) -> AtomicNumberTable:
+    if isinstance(zs, np.ndarray):
+        return AtomicNumberTable(np.unique(zs).tolist())
     return AtomicNumberTable(sorted(set(zs)))
 
 
@@ -227,12 +229,13 @@ def compute_average_E0s(
     """
     len_train = len(graphs)
     len_zs = len(z_table)
+    species = np.concatenate([graph.nodes.species for graph in graphs])
+    graph_index = np.repeat(
+        np.arange(len_train), [len(graph.nodes.species) for graph in graphs]
+    )
     A = np.zeros((len_train, len_zs))
-    B = np.zeros(len_train)
-    for i in range(len_train):
-        B[i] = graphs[i].globals.energy
-        for j, z in enumerate(z_table.zs):
-            A[i, j] = np.count_nonzero(graphs[i].nodes.species == z)
+    np.add.at(A, graph_index, species[:, None] == np.asarray(z_table.zs))
+    B = np.reshape([graph.globals.energy for graph in graphs], (len_train,))
     try:
         E0s = np.linalg.lstsq(A, B, rcond=None)[0]
         atomic_energies_dict = {}
@@ -281,6 +284,14 @@ def graph_from_configuration(config: Configuration, cutoff: float) -> jraph.Grap
 
 
 class GraphDataLoader:
+    """Iterate over batches of graphs.
+
+    Several graphs are packed into a single `jraph.GraphsTuple` (their nodes and
+    edges are concatenated) and the batch is padded with `jraph.pad_with_graphs`.
+    The model therefore processes a whole batch in one call, without a leading
+    batch axis, and the padding keeps the number of distinct shapes small.
+    """
+
     def __init__(
         self,
         graphs: List[jraph.GraphsTuple],
@@ -50,6 +50,8 @@ class MACE(hk.Module):
         off_diagonal: bool = False,
         interaction_irreps: Union[str, e3nn.Irreps] = "o3_restricted",  # or o3_full
         node_embedding: hk.Module = LinearNodeEmbeddingBlock,
+        scan_layers: bool = False,  # Scan over the intermediate layers instead of unrolling them
+        reduce_layers: Optional[str] = None,  # "sum": sum the outputs of the layers
     ):
         super().__init__()
 
@@ -88,6 +90,11 @@ class MACE(hk.Module):
         self.num_species = num_species
         self.symmetric_tensor_product_basis = symmetric_tensor_product_basis
         self.off_diagonal = off_diagonal
+        self.scan_layers = scan_layers
+
+        if reduce_layers not in (None, "sum"):
+            raise ValueError(f"reduce_layers={reduce_layers} is not supported")
+        self.reduce_layers = reduce_layers
 
         # Embeddings
         self.node_embedding = node_embedding(
@@ -118,7 +125,8 @@ class MACE(hk.Module):
         )  # [n_nodes, feature * irreps]
         node_feats = profile("embedding: node_feats", node_feats)
 
-        lengths = safe_norm(vectors, axis=-1)
+        # Shared by the radial and the angular embeddings
+        lengths = safe_norm(vectors, axis=-1)  # [n_edges]
 
         edge_attrs = e3nn.concatenate(
             [
@@ -134,9 +142,7 @@ class MACE(hk.Module):
 
         edge_attrs = profile("embedding: edge_attrs", edge_attrs)
 
-        # Interactions
-        outputs = []
-        for i in range(self.num_interactions):
+        def mace_layer(node_feats: e3nn.IrrepsArray, i: int, name: str):
             first = i == 0
             last = i == self.num_interactions - 1
 
@@ -146,7 +152,7 @@ class MACE(hk.Module):
                 else self.hidden_irreps.filter(self.output_irreps)
             )
 
-            node_outputs, node_feats = MACELayer(
+            return MACELayer(
                 first=first,
                 last=last,
                 num_features=self.num_features,
@@ -161,7 +167,7 @@ class MACE(hk.Module):
                 readout_mlp_irreps=self.readout_mlp_irreps,
                 symmetric_tensor_product_basis=self.symmetric_tensor_product_basis,
                 off_diagonal=self.off_diagonal,
-                name=f"layer_{i}",
+                name=name,
             )(
                 node_feats,
                 node_specie,
@@ -169,8 +175,48 @@ class MACE(hk.Module):
                 senders,
                 receivers,
             )
-            outputs += [node_outputs]  # list of [n_nodes, output_irreps]
 
+        # Interactions
+        if self.scan_layers and self.num_interactions > 2:
+            # The intermediate layers all have the same structure:
+            # their parameters are stacked and a single layer is compiled
+            num_middle = self.num_interactions - 2
+
+            node_outputs, node_feats = mace_layer(node_feats, 0, "layer_0")
+            outputs = [node_outputs]
+
+            if self.reduce_layers == "sum":
+                # Accumulate the outputs in the carry instead of stacking them
+                @hk.experimental.layer_stack(num_middle, name="middle_layers")
+                def middle_layers(node_feats, total):
+                    node_outputs, node_feats = mace_layer(node_feats, 1, "layer")
+                    return node_feats, total + node_outputs
+
+                node_feats, total = middle_layers(node_feats, node_outputs)
+                outputs = [total]
+            else:
+
+                @hk.experimental.layer_stack(
+                    num_middle, with_per_layer_inputs=True, name="middle_layers"
+                )
+                def middle_layers(node_feats):
+                    node_outputs, node_feats = mace_layer(node_feats, 1, "layer")
+                    return node_feats, node_outputs
+
+                node_feats, middle_outputs = middle_layers(node_feats)
+                outputs += [middle_outputs[j] for j in range(num_middle)]
+
+            i = self.num_interactions - 1
+            node_outputs, node_feats = mace_layer(node_feats, i, f"layer_{i}")
+            outputs += [node_outputs]
+        else:
+            outputs = []
+            for i in range(self.num_interactions):
+                node_outputs, node_feats = mace_layer(node_feats, i, f"layer_{i}")
+                outputs += [node_outputs]  # list of [n_nodes, output_irreps]
+
+        if self.reduce_layers == "sum":
+            return sum(outputs[1:], outputs[0])  # [n_nodes, output_irreps]
         return e3nn.stack(outputs, axis=1)  # [n_nodes, num_interactions, output_irreps]
 
 
@@ -1,13 +1,15 @@
 import argparse
 import glob
-import json
 import os
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
 
+import matplotlib
 import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 
+matplotlib.use("Agg")
+
 fig_width = 2.5
 fig_height = 2.1
 
@@ -27,16 +29,11 @@ colors = [
 ]
 
 
-def parse_training_results(path: str) -> List[dict]:
-    results = []
-    with open(path, mode="r", encoding="utf-8") as f:
-        for line in f:
-            d = json.loads(line)
-            d["path"] = os.path.dirname(path)
-            d["name"] = os.path.basename(path).split(".")[0]
-            results.append(d)
-
-    return results
+def parse_training_results(path: str) -> pd.DataFrame:
+    data = pd.read_json(path, lines=True)
+    data["path"] = os.path.dirname(path)
+    data["name"] = os.path.basename(path).split(".")[0]
+    return data
 
 
 def parse_args() -> argparse.Namespace:
@@ -48,9 +45,17 @@ def parse_args() -> argparse.Namespace:
 
 
 def plot(data: pd.DataFrame, output_path: str) -> None:
+    keys = ["path", "name", "mode", "interval"]
     data = (
-        data.groupby(["path", "name", "mode", "interval"])
-        .agg([np.mean, np.std])
+        data.groupby(keys, sort=False)
+        .agg(
+            mean_loss=("loss", "mean"),
+            std_loss=("loss", "std"),
+            mean_mae_e=("mae_e", "mean"),
+            std_mae_e=("mae_e", "std"),
+            mean_mae_f=("mae_f", "mean"),
+            std_mae_f=("mae_f", "std"),
+        )
         .reset_index()
     )
 
@@ -64,30 +69,30 @@ def plot(data: pd.DataFrame, output_path: str) -> None:
     ax = axes[0]
     ax.plot(
         valid_data["interval"],
-        valid_data["loss"]["mean"],
+        valid_data["mean_loss"],
         color=colors[0],
         zorder=1,
         label="Validation",
     )
     # ax.fill_between(
     #     x=valid_data["interval"],
-    #     y1=valid_data["loss"]["mean"] - valid_data["loss"]["std"],
-    #     y2=valid_data["loss"]["mean"] + valid_data["loss"]["std"],
+    #     y1=valid_data["mean_loss"] - valid_data["std_loss"],
+    #     y2=valid_data["mean_loss"] + valid_data["std_loss"],
     #     alpha=0.5,
     #     zorder=-1,
     #     color=colors[0],
     # )
     ax.plot(
         train_data["interval"],
-        train_data["loss"]["mean"],
+        train_data["mean_loss"],
         color=colors[3],
         zorder=1,
         label="Training",
     )
     # ax.fill_between(
     #     x=train_data["interval"],
-    #     y1=train_data["loss"]["mean"] - train_data["loss"]["std"],
-    #     y2=train_data["loss"]["mean"] + train_data["loss"]["std"],
+    #     y1=train_data["mean_loss"] - train_data["std_loss"],
+    #     y2=train_data["mean_loss"] + train_data["std_loss"],
     #     alpha=0.5,
     #     zorder=-1,
     #     color=colors[3],
@@ -102,30 +107,30 @@ def plot(data: pd.DataFrame, output_path: str) -> None:
     ax = axes[1]
     ax.plot(
         valid_data["interval"],
-        valid_data["mae_e"]["mean"],
+        valid_data["mean_mae_e"],
         color=colors[1],
         zorder=1,
         label="MAE Energy [eV]",
     )
     # ax.fill_between(
     #     x=valid_data["interval"],
-    #     y1=valid_data["mae_e"]["mean"] - valid_data["mae_e"]["std"],
-    #     y2=valid_data["mae_e"]["mean"] + valid_data["mae_e"]["std"],
+    #     y1=valid_data["mean_mae_e"] - valid_data["std_mae_e"],
+    #     y2=valid_data["mean_mae_e"] + valid_data["std_mae_e"],
     #     alpha=0.5,
     #     zorder=-1,
     #     color=colors[1],
     # )
     ax.plot(
         valid_data["interval"],
-        valid_data["mae_f"]["mean"],
+        valid_data["mean_mae_f"],
         color=colors[2],
         zorder=1,
         label="MAE Forces [eV/Å]",
     )
     # ax.fill_between(
     #     x=valid_data["interval"],
-    #     y1=valid_data["mae_f"]["mean"] - valid_data["mae_f"]["std"],
-    #     y2=valid_data["mae_f"]["mean"] + valid_data["mae_f"]["std"],
+    #     y1=valid_data["mean_mae_f"] - valid_data["std_mae_f"],
+    #     y2=valid_data["mean_mae_f"] + valid_data["std_mae_f"],
     #     alpha=0.5,
     #     zorder=-1,
     #     color=colors[2],
@@ -141,6 +146,11 @@ def plot(data: pd.DataFrame, output_path: str) -> None:
     plt.close(fig)
 
 
+def _plot_one(args: Tuple[str, str, pd.DataFrame]) -> None:
+    path, name, group = args
+    plot(group, output_path=f"{path}/{name}.pdf")
+
+
 def get_paths(path: str) -> List[str]:
     if os.path.isfile(path):
         return [path]
@@ -154,14 +164,22 @@ def get_paths(path: str) -> List[str]:
 
 def main():
     args = parse_args()
-    data = pd.DataFrame(
-        results
-        for path in get_paths(args.path)
-        for results in parse_training_results(path)
+    data = pd.concat(
+        [parse_training_results(path) for path in get_paths(args.path)],
+        ignore_index=True,
     )
 
-    for (path, name), group in data.groupby(["path", "name"]):
-        plot(group, output_path=f"{path}/{name}.pdf")
+    # Each run is plotted in its own process
+    with ProcessPoolExecutor() as executor:
+        list(
+            executor.map(
+                _plot_one,
+                (
+                    (path, name, group)
+                    for (path, name), group in data.groupby(["path", "name"])
+                ),
+            )
+        )
 
 
 if __name__ == "__main__":
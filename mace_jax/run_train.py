@@ -47,7 +47,7 @@ def main():
     if checks(predictor, params, train_loader):
         return
 
-    gradient_transform, steps_per_interval, max_num_intervals = optimizer()
+    gradient_transform, steps_per_interval, max_num_intervals = optimizer(params=params)
     optimizer_state = gradient_transform.init(params)
 
     logging.info(f"Number of parameters: {tools.count_parameters(params)}")
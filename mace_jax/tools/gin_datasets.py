@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 import gin
 import numpy as np
@@ -29,7 +29,7 @@ def datasets(
     min_n_node: int = 1,
     min_n_edge: int = 1,
     min_n_graph: int = 1,
-    n_mantissa_bits: int = 1,
+    n_mantissa_bits: Optional[int] = 1,
     prefactor_stress: float = 1.0,
     remap_stress: np.ndarray = None,
 ) -> Tuple[
@@ -1,7 +1,10 @@
 import datetime
 import logging
+import os
 import pickle
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Dict, List, Optional
 
 import gin
@@ -11,8 +14,6 @@ import jraph
 import numpy as np
 import optax
 from tqdm import tqdm
-from unique_names_generator import get_random_name
-from unique_names_generator.data import ADJECTIVES, NAMES
 
 from mace_jax import modules, tools
 
@@ -25,11 +26,19 @@ def flags(
     dtype: str,
     seed: int,
     profile: bool = False,
+    compilation_cache_dir: Optional[str] = None,
+    matmul_precision: Optional[str] = None,
 ):
     jax.config.update("jax_debug_nans", debug)
     jax.config.update("jax_debug_infs", debug)
     tools.set_default_dtype(dtype)
+    if matmul_precision is not None:
+        # "bfloat16" or "tensorfloat32" run the float32 matmuls on the tensor cores
+        jax.config.update("jax_default_matmul_precision", matmul_precision)
     tools.set_seeds(seed)
+    if compilation_cache_dir is not None:
+        # Persist the compiled XLA programs across runs
+        jax.config.update("jax_compilation_cache_dir", compilation_cache_dir)
     if profile:
         import profile_nn_jax
 
@@ -46,6 +55,9 @@ def logs(
     date = datetime.datetime.now().strftime("%Y%m%d_%H%M")
 
     if name is None:
+        from unique_names_generator import get_random_name
+        from unique_names_generator.data import ADJECTIVES, NAMES
+
         name = get_random_name(
             separator="-", style="lowercase", combo=[ADJECTIVES, NAMES]
         )
@@ -63,8 +75,10 @@ def reload(params, path=None):
     if path is not None:
         logging.info(f"Reloading parameters from '{path}'")
         with open(path, "rb") as f:
-            _ = pickle.load(f)
             new_params = pickle.load(f)
+            if isinstance(new_params, str):
+                # older checkpoints start with the operative gin config
+                new_params = pickle.load(f)
 
         # check compatibility
         if jax.tree_util.tree_structure(params) != jax.tree_util.tree_structure(
@@ -78,6 +92,14 @@ def reload(params, path=None):
     return params
 
 
+def _save_checkpoint(path: str, params) -> None:
+    params = jax.device_get(params)
+    # Written aside and renamed, a killed job keeps the previous checkpoint
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump(params, f)
+    os.replace(f"{path}.tmp", path)
+
+
 @gin.configurable
 def checks(
     energy_forces_predictor, params, train_loader, *, enabled: bool = False
@@ -88,25 +110,32 @@ def checks(
     logging.info("We will check the normalization of the model and exit.")
     energies = []
     forces = []
-    for graph in tqdm(train_loader):
+    graph_masks = []
+    node_masks = []
+    for graph in tqdm(train_loader, total=train_loader.approx_length()):
         out = energy_forces_predictor(params, graph)
-        node_mask = jraph.get_node_padding_mask(graph)
-        graph_mask = jraph.get_graph_padding_mask(graph)
-        energies += [out["energy"][graph_mask]]
-        forces += [out["forces"][node_mask]]
-    en = jnp.concatenate(energies)
-    fo = jnp.concatenate(forces)
+        energies += [out["energy"]]
+        forces += [out["forces"]]
+        graph_masks += [jraph.get_graph_padding_mask(graph)]
+        node_masks += [jraph.get_node_padding_mask(graph)]
+    en = jnp.concatenate(energies)[np.concatenate(graph_masks)]
+    fo = jnp.concatenate(forces)[np.concatenate(node_masks)]
     fo = jnp.linalg.norm(fo, axis=1)
 
-    logging.info(f"Energy: {jnp.mean(en):.3f} +/- {jnp.std(en):.3f}")
-    logging.info(f"        min/max: {jnp.min(en):.3f}/{jnp.max(en):.3f}")
-    logging.info(f"        median: {jnp.median(en):.3f}")
-    logging.info(f"Forces: {jnp.mean(fo):.3f} +/- {jnp.std(fo):.3f}")
-    logging.info(f"        min/max: {jnp.min(fo):.3f}/{jnp.max(fo):.3f}")
-    logging.info(f"        median: {jnp.median(fo):.3f}")
+    # a single transfer to the host for all the statistics
+    stats = jax.device_get({"Energy": _statistics(en), "Forces": _statistics(fo)})
+    for name, (mean, std, min_, max_, median) in stats.items():
+        logging.info(f"{name}: {mean:.3f} +/- {std:.3f}")
+        logging.info(f"        min/max: {min_:.3f}/{max_:.3f}")
+        logging.info(f"        median: {median:.3f}")
     return True
 
 
+@jax.jit
+def _statistics(x: jnp.ndarray):
+    return jnp.mean(x), jnp.std(x), jnp.min(x), jnp.max(x), jnp.median(x)
+
+
 @gin.configurable
 def exponential_decay(
     lr: float,
@@ -159,17 +188,24 @@ def optimizer(
     lr=0.01,
     algorithm: Callable = optax.scale_by_adam,
     scheduler: Callable = constant_schedule,
+    params=None,
 ):
+    decayed_modules = ("linear_down", "symmetric_contraction")
+    decayed = re.compile("|".join(decayed_modules))
+
     def weight_decay_mask(params):
         params = tools.flatten_dict(params)
-        mask = {
-            k: any(("linear_down" in ki) or ("symmetric_contraction" in ki) for ki in k)
-            for k in params
-        }
-        assert any(any(("linear_down" in ki) for ki in k) for k in params)
-        assert any(any(("symmetric_contraction" in ki) for ki in k) for k in params)
+        names = {k: "/".join(k) for k in params}
+        mask = {k: decayed.search(name) is not None for k, name in names.items()}
+        # each of the modules has decayed parameters
+        found = {m.group() for name in names.values() for m in decayed.finditer(name)}
+        assert found == set(decayed_modules)
         return tools.unflatten_dict(mask)
 
+    if params is not None:
+        # The mask only depends on the names of the parameters, compute it once
+        weight_decay_mask = weight_decay_mask(params)
+
     return (
         optax.chain(
             optax.add_decayed_weights(weight_decay, mask=weight_decay_mask),
@@ -210,6 +246,14 @@ def train(
     total_time_per_interval = []
     eval_time_per_interval = []
 
+    # The configuration does not change during training, it is saved only once
+    with open(f"{directory}/{tag}.operative.gin", "wt") as f:
+        f.write(gin.operative_config_str())
+
+    # Checkpoints are written in the background while training continues
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    checkpoint = None
+
     for interval, params, optimizer_state, ema_params in tools.train(
         model=model,
         params=params,
@@ -232,9 +276,11 @@ def train(
 
         last_interval = interval == max_num_intervals
 
-        with open(f"{directory}/{tag}.pkl", "wb") as f:
-            pickle.dump(gin.operative_config_str(), f)
-            pickle.dump(params, f)
+        if checkpoint is not None:
+            checkpoint.result()  # raise if the previous checkpoint failed
+        checkpoint = checkpoint_executor.submit(
+            _save_checkpoint, f"{directory}/{tag}.pkl", params
+        )
 
         def eval_and_print(loader, mode: str):
             loss_, metrics_ = tools.evaluate(
@@ -335,34 +381,38 @@ def train(
         if last_interval:
             break
 
+    checkpoint_executor.shutdown(wait=True)
+    if checkpoint is not None:
+        checkpoint.result()  # raise if the last checkpoint failed
+
     logging.info("Training complete")
     return interval, ema_params
 
 
 def parse_argv(argv: List[str]):
-    def gin_bind_parameter(key: str, value: str):
+    def gin_binding(key: str, value: str) -> str:
         # We need to guess if value is a string or not
         value = value.strip()
         if value[0] == value[-1] and value[0] in ('"', "'"):
-            gin.parse_config(f"{key} = {value}")
+            return f"{key} = {value}"
         if value[0] == "@":
-            gin.parse_config(f"{key} = {value}")
+            return f"{key} = {value}"
         if value in ["True", "False", "None"]:
-            gin.parse_config(f"{key} = {value}")
+            return f"{key} = {value}"
         if any(c.isalpha() for c in value):
-            gin.parse_config(f'{key} = "{value}"')
-        else:
-            gin.parse_config(f"{key} = {value}")
+            return f'{key} = "{value}"'
+        return f"{key} = {value}"
 
+    bindings = []
     only_the_key = None
     for arg in argv[1:]:
         if only_the_key is None:
             if arg.endswith(".gin"):
-                gin.parse_config_file(arg)
+                bindings.append(f"include {arg!r}")
             elif arg.startswith("--"):
                 if "=" in arg:
                     key, value = arg[2:].split("=")
-                    gin_bind_parameter(key, value)
+                    bindings.append(gin_binding(key, value))
                 else:
                     only_the_key = arg[2:]
             else:
@@ -370,5 +420,9 @@ def parse_argv(argv: List[str]):
                     f"Unknown argument: '{arg}'. Expected a .gin file or a --key \"some value\" pair."
                 )
         else:
-            gin_bind_parameter(only_the_key, arg)
+            bindings.append(gin_binding(only_the_key, arg))
             only_the_key = None
+
+    # Parsed in the order of argv, a later file or binding overrides the earlier
+    # ones. The config is not finalized, it can still be changed afterwards.
+    gin.parse_config_files_and_bindings(None, bindings, finalize_config=False)
@@ -1,5 +1,7 @@
+import contextlib
+import functools
 import logging
-from typing import Callable, Dict, List, Optional, Union
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import ase.data
 import e3nn_jax as e3nn
@@ -57,26 +59,287 @@ def u_envelope(length, max_length, p: int):
 
 gin.external_configurable(modules.LinearNodeEmbeddingBlock, "LinearEmbedding")
 
+# Kept as numpy arrays to not allocate device memory at import time
+_ATOMIC_MASSES_NP = np.asarray(ase.data.atomic_masses, dtype=np.float32)
+_ATOMIC_MASSES_SCALED = _ATOMIC_MASSES_NP / 90.0
+_ATOMIC_MASSES_NP.setflags(write=False)
+_ATOMIC_MASSES_SCALED.setflags(write=False)
+
 
 @gin.configurable
 class LinearMassEmbedding(hk.Module):
-    def __init__(self, num_species: int, irreps_out: e3nn.Irreps):
+    def __init__(
+        self,
+        num_species: int,
+        irreps_out: e3nn.Irreps,
+        param_dtype: jnp.dtype = jnp.float32,
+        compute_dtype: jnp.dtype = jnp.float32,
+    ):
         super().__init__()
         self.num_species = num_species
         self.irreps_out = e3nn.Irreps(irreps_out).filter("0e").regroup()
+        # e.g. param_dtype = "bfloat16" halves the memory of the table
+        self.param_dtype = jnp.dtype(param_dtype)
+        self.compute_dtype = jnp.dtype(compute_dtype)
 
     def __call__(self, node_specie: jnp.ndarray) -> e3nn.IrrepsArray:
         w = hk.get_parameter(
             "embeddings",
             shape=(self.num_species, self.irreps_out.dim),
-            dtype=jnp.float32,
+            dtype=self.param_dtype,
             init=hk.initializers.RandomNormal(),
         )
-        atomic_masses = jnp.asarray(ase.data.atomic_masses)[node_specie] / 90.0  # [...]
-        return e3nn.IrrepsArray(
-            self.irreps_out, w[node_specie] * atomic_masses[..., None]
+        # Scale the table before the gather, there are fewer species than nodes
+        atomic_masses = _ATOMIC_MASSES_SCALED[: self.num_species]
+        # Species past the last element get its mass, as a clamped gather would
+        atomic_masses = jnp.asarray(
+            np.pad(atomic_masses, (0, self.num_species - len(atomic_masses)), "edge")
+        )
+        w = w.astype(self.compute_dtype) * atomic_masses[:, None].astype(
+            self.compute_dtype
+        )  # [num_species, irreps_out.dim]
+        return e3nn.IrrepsArray(self.irreps_out, w[node_specie])
+
+
+class _DatasetStats:
+    """Statistics of the training graphs, each computed on first access.
+
+    Only the fields a statistic needs are concatenated, the graphs are never
+    batched as a whole.
+    """
+
+    def __init__(self, graphs: List[jraph.GraphsTuple]):
+        self.graphs = graphs
+
+    @functools.cached_property
+    def species(self) -> np.ndarray:
+        return np.concatenate([graph.nodes.species for graph in self.graphs])
+
+    @functools.cached_property
+    def z_table(self) -> data.AtomicNumberTable:
+        return data.get_atomic_number_table_from_zs(self.species)
+
+    @functools.cached_property
+    def avg_num_neighbors(self) -> float:
+        return tools.compute_avg_num_neighbors(self.graphs)
+
+    @functools.cached_property
+    def avg_r_min(self) -> float:
+        return tools.compute_avg_min_neighbor_distance(self.graphs)
+
+    @functools.cached_property
+    def average_E0s(self) -> Dict[int, float]:
+        return data.compute_average_E0s(self.graphs, self.z_table)
+
+
+def _dict_to_dense(d: Dict[int, float], n: int, dtype=np.float64) -> np.ndarray:
+    """Array of length ``n`` with ``d[z]`` at index ``z``, zero for missing keys."""
+    keys = np.fromiter(d.keys(), dtype=np.int64, count=len(d))
+    values = np.fromiter(d.values(), dtype=dtype, count=len(d))
+    mask = (keys >= 0) & (keys < n)
+    dense = np.zeros(n, dtype=dtype)
+    dense[keys[mask]] = values[mask]
+    return dense
+
+
+class _AtomicEnergiesContext(NamedTuple):
+    """What the named atomic energies are built from."""
+
+    atomic_energies_dict: Optional[Dict[int, float]]
+    stats: Optional[_DatasetStats]
+    num_species: int
+    dtype: np.dtype
+
+
+def _average_atomic_energies(ctx: _AtomicEnergiesContext) -> np.ndarray:
+    atomic_energies_dict = ctx.stats.average_E0s
+    logging.info(
+        f"Computed average Atomic Energies using least squares: {atomic_energies_dict}"
+    )
+    return _dict_to_dense(atomic_energies_dict, ctx.num_species, ctx.dtype)
+
+
+def _isolated_atom_energies(ctx: _AtomicEnergiesContext) -> np.ndarray:
+    logging.info(
+        f"Using atomic energies from isolated atoms in the dataset: {ctx.atomic_energies_dict}"
+    )
+    return _dict_to_dense(ctx.atomic_energies_dict, ctx.num_species, ctx.dtype)
+
+
+def _zero_atomic_energies(ctx: _AtomicEnergiesContext) -> np.ndarray:
+    logging.info("Not using atomic energies")
+    return np.zeros(ctx.num_species, dtype=ctx.dtype)
+
+
+# How `model` builds the atomic energies when they are given by name
+_AE_STR_HANDLERS = {
+    "average": _average_atomic_energies,
+    "isolated_atom": _isolated_atom_energies,
+    "zero": _zero_atomic_energies,
+}
+
+
+def _freeze(x):
+    if isinstance(x, np.ndarray):
+        x = x.tolist()
+    if isinstance(x, (list, tuple)):
+        # The type is part of the key, e.g. e3nn.Irreps is a tuple subclass
+        return (type(x), tuple(_freeze(y) for y in x))
+    return x
+
+
+# Global options of e3nn that modules read while they are traced
+_E3NN_OPTIONS = (
+    "irrep_normalization",
+    "path_normalization",
+    "gradient_normalization",
+    "spherical_harmonics_algorithm",
+    "spherical_harmonics_normalization",
+    "custom_einsum_jvp",
+    "fused",
+    "sparse_tp",
+)
+
+
+def _trace_state() -> Tuple:
+    """Global state read when the model is traced, not given to `_make_model_fn`.
+
+    The gin bindings of the configurables called inside the model (e.g.
+    ``bessel_basis.number``) and the global options of e3nn.
+    """
+    e3nn_options = []
+    for name in _E3NN_OPTIONS:
+        try:
+            e3nn_options.append((name, e3nn.config(name)))
+        except KeyError:  # not an option of this version of e3nn
+            pass
+    return gin.config_str(), tuple(e3nn_options)
+
+
+class _ModelKwargs:
+    """Keyword arguments of `_make_model_fn`, hashed on their frozen values.
+
+    The key also holds the `_trace_state`, the cached functions are traced with it.
+    """
+
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.key = (
+            tuple(sorted((k, _freeze(v)) for k, v in kwargs.items())),
+            _trace_state(),
         )
 
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+@contextlib.contextmanager
+def _e3nn_config(**options):
+    """Set global options of e3nn and restore their previous values on exit."""
+    previous = {name: e3nn.config(name) for name in options}
+    for name, value in options.items():
+        e3nn.config(name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            e3nn.config(name, value)
+
+
+def _make_model_fn(
+    *,
+    path_normalization: str,
+    gradient_normalization: str,
+    learnable_atomic_energies: bool,
+    num_species: int,
+    **kwargs,
+) -> Tuple[Callable, Callable]:
+    @hk.without_apply_rng
+    @hk.transform
+    @_e3nn_config(  # global options of e3nn, read while tracing
+        path_normalization=path_normalization,
+        gradient_normalization=gradient_normalization,
+    )
+    def model_(
+        vectors: jnp.ndarray,  # [n_edges, 3]
+        node_z: jnp.ndarray,  # [n_nodes]
+        senders: jnp.ndarray,  # [n_edges]
+        receivers: jnp.ndarray,  # [n_edges]
+        atomic_energies: jnp.ndarray,  # [num_species]
+        mean: float,
+        std: float,
+    ) -> jnp.ndarray:
+        mace = modules.MACE(
+            output_irreps="0e", reduce_layers="sum", num_species=num_species, **kwargs
+        )
+
+        if hk.running_init():
+            logging.info(
+                "model: "
+                f"num_features={mace.num_features} "
+                f"hidden_irreps={mace.hidden_irreps} "
+                f"sh_irreps={mace.sh_irreps} "
+                f"interaction_irreps={mace.interaction_irreps} ",
+            )
+
+        contributions = mace(vectors, node_z, senders, receivers)  # [n_nodes, 0e]
+        contributions = contributions.array[:, 0]  # summed over the layers
+
+        if learnable_atomic_energies:
+            atomic_energies = hk.get_parameter(
+                "atomic_energies",
+                shape=(num_species,),
+                init=hk.initializers.Constant(atomic_energies),
+            )
+        else:
+            atomic_energies = jax.lax.stop_gradient(atomic_energies)
+        bias = mean + atomic_energies  # [num_species]
+
+        node_energies = std * contributions + bias[node_z]  # [n_nodes, ]
+
+        return node_energies
+
+    # No buffer donation: the inputs are small next to the activations and callers
+    # (e.g. the predictor differentiating w.r.t. the edge vectors) reuse them.
+    return jax.jit(model_.apply), jax.jit(model_.init)
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_make_model_fn(kwargs: _ModelKwargs) -> Tuple[Callable, Callable]:
+    return _make_model_fn(**kwargs.kwargs)
+
+
+def _build_model_fn(
+    *, mean: float, std: float, atomic_energies: np.ndarray, **kwargs
+) -> Tuple[Callable, Callable]:
+    """Return the apply and init functions of the model.
+
+    The jitted functions are cached on the other (frozen) arguments. The energy
+    scaling and the atomic energies are passed to them as arguments, so models
+    that only differ by these reuse the compiled code.
+    """
+    kwargs = _ModelKwargs(kwargs)
+    try:
+        hash(kwargs)
+    except TypeError:
+        apply_fn, init_fn = _make_model_fn(**kwargs.kwargs)
+    else:
+        apply_fn, init_fn = _cached_make_model_fn(kwargs)
+
+    # Transferred once instead of at every call
+    constants = jax.device_put((atomic_energies, mean, std))
+
+    def apply(params, vectors, node_z, senders, receivers):
+        return apply_fn(params, vectors, node_z, senders, receivers, *constants)
+
+    def init(rng, vectors, node_z, senders, receivers):
+        return init_fn(rng, vectors, node_z, senders, receivers, *constants)
+
+    return apply, init
+
 
 @gin.configurable
 def model(
@@ -98,16 +361,26 @@ def model(
     radial_envelope: Callable[[jnp.ndarray], jnp.ndarray] = soft_envelope,
     **kwargs,
 ):
-    if train_graphs is None:
-        z_table = None
+    if atomic_energies is None:
+        if atomic_energies_dict is None or len(atomic_energies_dict) == 0:
+            atomic_energies = "average"
+        else:
+            atomic_energies = "isolated_atom"
+
+    # Scan the training set only if one of its statistics is needed
+    if train_graphs is not None and any(
+        isinstance(x, str) and x == "average"
+        for x in (avg_num_neighbors, avg_r_min, atomic_energies)
+    ):
+        stats = _DatasetStats(train_graphs)
+        z_table = stats.z_table
     else:
-        z_table = data.get_atomic_number_table_from_zs(
-            z for graph in train_graphs for z in graph.nodes.species
-        )
+        stats = None
+        z_table = None
     logging.info(f"z_table= {z_table}")
 
     if avg_num_neighbors == "average":
-        avg_num_neighbors = tools.compute_avg_num_neighbors(train_graphs)
+        avg_num_neighbors = stats.avg_num_neighbors
         logging.info(
             f"Compute the average number of neighbors: {avg_num_neighbors:.3f}"
         )
@@ -115,38 +388,17 @@ def model(
         logging.info(f"Use the average number of neighbors: {avg_num_neighbors:.3f}")
 
     if avg_r_min == "average":
-        avg_r_min = tools.compute_avg_min_neighbor_distance(train_graphs)
+        avg_r_min = stats.avg_r_min
         logging.info(f"Compute the average min neighbor distance: {avg_r_min:.3f}")
     elif avg_r_min is None:
         logging.info("Do not normalize the radial basis (avg_r_min=None)")
     else:
         logging.info(f"Use the average min neighbor distance: {avg_r_min:.3f}")
 
-    if atomic_energies is None:
-        if atomic_energies_dict is None or len(atomic_energies_dict) == 0:
-            atomic_energies = "average"
-        else:
-            atomic_energies = "isolated_atom"
+    # float32 unless x64 is enabled, the dtype the energies have on the device
+    ae_dtype = jax.dtypes.canonicalize_dtype(np.float64)
 
-    if atomic_energies == "average":
-        atomic_energies_dict = data.compute_average_E0s(train_graphs, z_table)
-        logging.info(
-            f"Computed average Atomic Energies using least squares: {atomic_energies_dict}"
-        )
-        atomic_energies = np.array(
-            [atomic_energies_dict.get(z, 0.0) for z in range(num_species)]
-        )
-    elif atomic_energies == "isolated_atom":
-        logging.info(
-            f"Using atomic energies from isolated atoms in the dataset: {atomic_energies_dict}"
-        )
-        atomic_energies = np.array(
-            [atomic_energies_dict.get(z, 0.0) for z in range(num_species)]
-        )
-    elif atomic_energies == "zero":
-        logging.info("Not using atomic energies")
-        atomic_energies = np.zeros(num_species)
-    elif isinstance(atomic_energies, np.ndarray):
+    if isinstance(atomic_energies, np.ndarray):
         logging.info(
             f"Use Atomic Energies that are provided: {atomic_energies.tolist()}"
         )
@@ -155,28 +407,29 @@ def model(
                 f"atomic_energies.shape={atomic_energies.shape} != (num_species={num_species},)"
             )
             raise ValueError
+        atomic_energies = atomic_energies.astype(ae_dtype, copy=False)
     elif isinstance(atomic_energies, dict):
         atomic_energies_dict = atomic_energies
         logging.info(f"Use Atomic Energies that are provided: {atomic_energies_dict}")
-        atomic_energies = np.array(
-            [atomic_energies_dict.get(z, 0.0) for z in range(num_species)]
+        atomic_energies = _dict_to_dense(atomic_energies_dict, num_species, ae_dtype)
+    elif isinstance(atomic_energies, str) and atomic_energies in _AE_STR_HANDLERS:
+        atomic_energies = _AE_STR_HANDLERS[atomic_energies](
+            _AtomicEnergiesContext(atomic_energies_dict, stats, num_species, ae_dtype)
         )
     else:
         raise ValueError(f"atomic_energies={atomic_energies} is not supported")
 
     # check that num_species is consistent with the dataset
-    if z_table is None:
-        if train_graphs is not None:
-            for graph in train_graphs:
-                if not np.all(graph.nodes.species < num_species):
-                    raise ValueError(
-                        f"max(graph.nodes.species)={np.max(graph.nodes.species)} >= num_species={num_species}"
-                    )
+    if stats is not None:
+        max_species = int(stats.species.max())
+    elif train_graphs is not None:
+        max_species = max(
+            (int(graph.nodes.species.max()) for graph in train_graphs), default=-1
+        )
     else:
-        if max(z_table.zs) >= num_species:
-            raise ValueError(
-                f"max(z_table.zs)={max(z_table.zs)} >= num_species={num_species}"
-            )
+        max_species = -1
+    if max_species >= num_species:
+        raise ValueError(f"max(species)={max_species} >= num_species={num_species}")
 
     if scaling is None:
         mean, std = 0.0, 1.0
@@ -199,57 +452,58 @@ def model(
     )
     logging.info(f"Create MACE with parameters {kwargs}")
 
-    @hk.without_apply_rng
-    @hk.transform
-    def model_(
-        vectors: jnp.ndarray,  # [n_edges, 3]
-        node_z: jnp.ndarray,  # [n_nodes]
-        senders: jnp.ndarray,  # [n_edges]
-        receivers: jnp.ndarray,  # [n_edges]
-    ) -> jnp.ndarray:
-        e3nn.config("path_normalization", path_normalization)
-        e3nn.config("gradient_normalization", gradient_normalization)
-
-        mace = modules.MACE(output_irreps="0e", **kwargs)
-
-        if hk.running_init():
-            logging.info(
-                "model: "
-                f"num_features={mace.num_features} "
-                f"hidden_irreps={mace.hidden_irreps} "
-                f"sh_irreps={mace.sh_irreps} "
-                f"interaction_irreps={mace.interaction_irreps} ",
-            )
-
-        contributions = mace(
-            vectors, node_z, senders, receivers
-        )  # [n_nodes, num_interactions, 0e]
-        contributions = contributions.array[:, :, 0]  # [n_nodes, num_interactions]
-        node_energies = jnp.sum(contributions, axis=1)  # [n_nodes, ]
-
-        node_energies = mean + std * node_energies
-
-        if learnable_atomic_energies:
-            atomic_energies_ = hk.get_parameter(
-                "atomic_energies",
-                shape=(num_species,),
-                init=hk.initializers.Constant(atomic_energies),
-            )
-        else:
-            atomic_energies_ = jnp.asarray(atomic_energies)
-        node_energies += atomic_energies_[node_z]  # [n_nodes, ]
-
-        return node_energies
+    apply_fn, init_fn = _build_model_fn(
+        path_normalization=path_normalization,
+        gradient_normalization=gradient_normalization,
+        mean=mean,
+        std=std,
+        atomic_energies=atomic_energies,
+        learnable_atomic_energies=learnable_atomic_energies,
+        **kwargs,
+    )
 
+    dummy_inputs = (
+        jnp.zeros((1, 3)),
+        jnp.array([16]),
+        jnp.array([0]),
+        jnp.array([0]),
+    )
     if initialize_seed is not None:
-        params = jax.jit(model_.init)(
-            jax.random.PRNGKey(initialize_seed),
-            jnp.zeros((1, 3)),
-            jnp.array([16]),
-            jnp.array([0]),
-            jnp.array([0]),
-        )
+        params = init_fn(jax.random.PRNGKey(initialize_seed), *dummy_inputs)
     else:
-        params = None
-
-    return model_.apply, params, num_interactions
+        # Only the shapes and dtypes of the parameters (jax.ShapeDtypeStruct), this
+        # does not compile nor run the initialization
+        params = jax.eval_shape(init_fn, jax.random.PRNGKey(0), *dummy_inputs)
+
+    return apply_fn, params, num_interactions
+
+
+def _next_power_of_two(n: int) -> int:
+    return 1 << max(n - 1, 0).bit_length()
+
+
+def padded_apply(
+    apply_fn: Callable,
+    params,
+    vectors: np.ndarray,  # [n_edges, 3]
+    node_z: np.ndarray,  # [n_nodes]
+    senders: np.ndarray,  # [n_edges]
+    receivers: np.ndarray,  # [n_edges]
+) -> jnp.ndarray:
+    """Call the ``apply_fn`` returned by `model` on inputs padded to powers of two.
+
+    The jitted function is then compiled once per size bucket instead of once per
+    number of nodes and edges. The padding edges connect an extra node to itself
+    with zero vectors, so they do not affect the energies of the real nodes.
+    """
+    n_node, n_edge = len(node_z), len(senders)
+    pad_node = _next_power_of_two(n_node + 1) - n_node  # at least one padding node
+    pad_edge = _next_power_of_two(n_edge) - n_edge
+
+    vectors = np.pad(np.asarray(vectors), ((0, pad_edge), (0, 0)))
+    node_z = np.pad(np.asarray(node_z), (0, pad_node))
+    senders = np.pad(np.asarray(senders), (0, pad_edge), constant_values=n_node)
+    receivers = np.pad(np.asarray(receivers), (0, pad_edge), constant_values=n_node)
+
+    node_energies = apply_fn(params, vectors, node_z, senders, receivers)
+    return node_energies[:n_node]  # [n_nodes]
@@ -28,26 +28,41 @@ def predict_energy_forces_stress(
             pressure: [n_graphs,] pressure [eV / A^3]
     """
 
-    def energy_fn(positions, cell):
-        vectors = tools.get_edge_relative_vectors(
-            positions=positions,
-            senders=graph.senders,
-            receivers=graph.receivers,
-            shifts=graph.edges.shifts,
-            cell=cell,
-            n_edge=graph.n_edge,
-        )
+    vectors = tools.get_edge_relative_vectors(
+        positions=graph.nodes.positions,
+        senders=graph.senders,
+        receivers=graph.receivers,
+        shifts=graph.edges.shifts,
+        cell=graph.globals.cell,
+        n_edge=graph.n_edge,
+    )  # [n_edges, 3]
+
+    def energy_fn(vectors):
         node_energies = model(
             vectors, graph.nodes.species, graph.senders, graph.receivers
         )  # [n_nodes, ]
         assert node_energies.shape == (
-            len(positions),
+            len(graph.nodes.positions),
         ), "model output needs to be an array of shape (n_nodes, )"
         return jnp.sum(node_energies), node_energies
 
-    (minus_forces, pseudo_stress), node_energies = jax.grad(
-        energy_fn, (0, 1), has_aux=True
-    )(graph.nodes.positions, graph.globals.cell)
+    # Differentiate with respect to the edge vectors only and apply the chain rule
+    # of vectors = positions[receivers] - positions[senders] - shifts @ cell by hand.
+    minus_edge_forces, node_energies = jax.grad(energy_fn, has_aux=True)(
+        vectors
+    )  # [n_edges, 3]
+
+    minus_forces = (
+        jnp.zeros_like(graph.nodes.positions)
+        .at[graph.receivers]
+        .add(minus_edge_forces)
+        .at[graph.senders]
+        .add(-minus_edge_forces)
+    )  # [n_nodes, 3]
+    pseudo_stress = -e3nn.scatter_sum(
+        jnp.einsum("ei,ej->eij", graph.edges.shifts, minus_edge_forces),
+        nel=graph.n_edge,
+    )  # [n_graphs, 3, 3]
 
     graph_energies = e3nn.scatter_sum(node_energies, nel=graph.n_node)  # [ n_graphs,]
 
@@ -1,7 +1,9 @@
 import itertools
 import logging
+import queue
+import threading
 import time
-from typing import Any, Callable, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
 
 import jax
 import jax.numpy as jnp
@@ -22,21 +24,56 @@ def train(
     optimizer_state: Dict[str, Any],
     steps_per_interval: int,
     ema_decay: Optional[float] = None,
+    data_parallel: bool = False,
+    prefetch_size: int = 2,
 ):
     num_updates = 0
     ema_params = params
 
     logging.info("Started training")
 
-    @jax.jit
-    def update_fn(
-        params, optimizer_state, ema_params, num_updates: int, graph: jraph.GraphsTuple
-    ) -> Tuple[float, Any, Any]:
+    def graph_loss_and_grad(params, graph: jraph.GraphsTuple) -> Tuple[float, Any]:
         # graph is assumed to be padded by jraph.pad_with_graphs
         mask = jraph.get_graph_padding_mask(graph)  # [n_graphs,]
-        loss, grad = jax.value_and_grad(
+        return jax.value_and_grad(
             lambda params: jnp.mean(loss_fn(graph, model(params, graph)) * mask)
         )(params)
+
+    loss_and_grad = graph_loss_and_grad
+    sharding = None
+
+    if data_parallel:
+        from jax.experimental.shard_map import shard_map
+        from jax.sharding import Mesh, NamedSharding, PartitionSpec
+
+        # Each device gets its own batch, the parameters are replicated
+        num_devices = jax.local_device_count()
+        mesh = Mesh(np.array(jax.local_devices()), ("dp",))
+        logging.info(f"Data parallel training over {num_devices} devices")
+
+        def device_loss_and_grad(params, graph: jraph.GraphsTuple):
+            graph = jax.tree_util.tree_map(lambda x: x[0], graph)
+            return jax.lax.pmean(graph_loss_and_grad(params, graph), "dp")
+
+        loss_and_grad = shard_map(
+            device_loss_and_grad,
+            mesh=mesh,
+            in_specs=(PartitionSpec(), PartitionSpec("dp")),
+            out_specs=PartitionSpec(),
+            check_rep=False,
+        )
+        sharding = NamedSharding(mesh, PartitionSpec("dp"))
+
+        params, optimizer_state, ema_params = jax.device_put(
+            (params, optimizer_state, ema_params),
+            NamedSharding(mesh, PartitionSpec()),
+        )
+
+    @jax.jit
+    def update_fn(
+        params, optimizer_state, ema_params, num_updates: int, graph: jraph.GraphsTuple
+    ) -> Tuple[float, Any, Any]:
+        loss, grad = loss_and_grad(params, graph)
         updates, optimizer_state = gradient_transform.update(
             grad, optimizer_state, params
         )
@@ -55,18 +92,34 @@ def train(
     def interval_loader():
         i = 0
         while True:
-            for graph in train_loader:
+            loader = train_loader
+            if data_parallel:
+                loader = _stack_graphs(train_loader, num_devices)
+            num_batches = 0
+            for graph in loader:
                 yield graph
+                num_batches += 1
                 i += 1
                 if i >= steps_per_interval:
                     return
+            if num_batches == 0:
+                # Otherwise this loop spins forever, in the prefetch thread if any
+                raise ValueError(
+                    "The training loader produced no batch"
+                    + (f" stacked over {num_devices} devices" if data_parallel else "")
+                )
+
+    def prefetched_loader():
+        if prefetch_size > 0:
+            return _prefetch_to_device(interval_loader(), prefetch_size, sharding)
+        return interval_loader()
 
     for interval in itertools.count():
         yield interval, params, optimizer_state, ema_params
 
         # Train one interval
         p_bar = tqdm.tqdm(
-            interval_loader(),
+            prefetched_loader(),
             desc=f"Train interval {interval}",
             total=steps_per_interval,
         )
@@ -91,6 +144,55 @@ def train(
                 )
 
 
+def _stack_graphs(
+    loader: Iterable[jraph.GraphsTuple], n: int
+) -> Iterator[jraph.GraphsTuple]:
+    """Stack groups of ``n`` padded graphs along a new leading axis."""
+    graphs = []
+    for graph in loader:
+        graphs.append(graph)
+        if len(graphs) == n:
+            shapes = {jax.tree_util.tree_map(np.shape, g) for g in graphs}
+            if len(shapes) > 1:
+                raise ValueError(
+                    "Batches stacked for data parallelism must have the same shape, "
+                    "pad them to the maximum sizes (datasets.n_mantissa_bits = None)."
+                )
+            yield jax.tree_util.tree_map(lambda *x: np.stack(x), *graphs)
+            graphs = []
+    if graphs:
+        logging.warning(
+            f"Dropped the last {len(graphs)} batches of the pass, "
+            f"fewer than the {n} devices."
+        )
+
+
+def _prefetch_to_device(
+    iterator: Iterator[Any], size: int, sharding: Optional[Any] = None
+) -> Iterator[Any]:
+    """Move the next ``size`` elements of ``iterator`` to the device in a thread."""
+    buffer = queue.Queue(maxsize=size)
+
+    def producer():
+        try:
+            for x in iterator:
+                buffer.put((True, jax.device_put(x, sharding)))
+        except Exception as e:  # re-raised in the consumer
+            buffer.put((False, e))
+        else:
+            buffer.put((False, None))
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    while True:
+        ok, x = buffer.get()
+        if not ok:
+            if x is not None:
+                raise x
+            return
+        yield x
+
+
 def evaluate(
     model: Callable,
     params: Any,
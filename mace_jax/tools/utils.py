@@ -182,31 +182,65 @@ def compute_mean_rms_energy_forces(
     raise NotImplementedError
 
 
-def compute_avg_num_neighbors(graphs: List[jraph.GraphsTuple]) -> float:
-    num_neighbors = []
-
-    for graph in graphs:
-        _, counts = np.unique(graph.receivers, return_counts=True)
-        num_neighbors.append(counts)
+def compute_avg_num_neighbors(
+    graphs: Union[List[jraph.GraphsTuple], jraph.GraphsTuple],
+) -> float:
+    if isinstance(graphs, jraph.GraphsTuple):
+        receivers = graphs.receivers
+    else:
+        # Only the receivers are concatenated, offset by the nodes of the
+        # previous graphs as in jraph.batch_np
+        n_node = np.array([graph.n_node.sum() for graph in graphs])
+        offsets = np.repeat(
+            np.cumsum(n_node) - n_node, [len(graph.receivers) for graph in graphs]
+        )
+        receivers = np.concatenate([graph.receivers for graph in graphs]) + offsets
+    counts = np.bincount(receivers)
+    return np.mean(counts[counts > 0]).item()
 
-    return np.mean(np.concatenate(num_neighbors)).item()
 
+def _geometry(graph: jraph.GraphsTuple) -> jraph.GraphsTuple:
+    """Keep only the fields the edge vectors depend on."""
+    return graph._replace(
+        nodes=graph.nodes.positions,
+        edges=graph.edges.shifts,
+        globals=graph.globals.cell,
+    )
 
-def compute_avg_min_neighbor_distance(graphs: List[jraph.GraphsTuple]) -> float:
-    min_neighbor_distances = []
 
-    for graph in graphs:
-        vectors = get_edge_relative_vectors(
-            graph.nodes.positions,
-            graph.senders,
-            graph.receivers,
-            graph.edges.shifts,
-            graph.globals.cell,
-            graph.n_edge,
+def _min_neighbor_distances(graph: jraph.GraphsTuple) -> np.ndarray:
+    """Shortest edge of each graph that has edges, ``graph`` as given by `_geometry`."""
+    vectors = get_edge_relative_vectors(
+        graph.nodes,
+        graph.senders,
+        graph.receivers,
+        graph.edges,
+        graph.globals,
+        graph.n_edge,
+    )
+    length = np.linalg.norm(np.asarray(vectors), axis=-1)
+
+    offsets = np.cumsum(graph.n_edge) - graph.n_edge
+    return np.minimum.reduceat(length, offsets[graph.n_edge > 0])
+
+
+def compute_avg_min_neighbor_distance(
+    graphs: Union[List[jraph.GraphsTuple], jraph.GraphsTuple],
+    chunk_size: int = 1024,
+) -> float:
+    if isinstance(graphs, jraph.GraphsTuple):
+        min_neighbor_distances = _min_neighbor_distances(_geometry(graphs))
+    else:
+        # Concatenated by chunks of graphs to bound the size of the arrays
+        # sent to the device
+        min_neighbor_distances = np.concatenate(
+            [
+                _min_neighbor_distances(
+                    jraph.batch_np([_geometry(g) for g in graphs[i : i + chunk_size]])
+                )
+                for i in range(0, len(graphs), chunk_size)
+            ]
         )
-        length = np.linalg.norm(vectors, axis=-1)
-        min_neighbor_distances.append(length.min())
-
     return np.mean(min_neighbor_distances).item()
 
 
@@ -93,6 +93,64 @@ def test_mace():
     assert_equivariant(wrapper, jax.random.PRNGKey(1), args_in=(positions,))
 
 
+def test_mace_scan_layers():
+    def model(scan_layers, reduce_layers=None):
+        @hk.without_apply_rng
+        @hk.transform
+        def f(vectors, node_specie, senders, receivers):
+            return MACE(
+                output_irreps="0e",
+                r_max=5.0,
+                num_interactions=4,
+                hidden_irreps="8x0e + 8x1o",
+                readout_mlp_irreps="4x0e",
+                avg_num_neighbors=3.0,
+                num_species=3,
+                radial_basis=lambda r, r_max: e3nn.bessel(r, 4, r_max),
+                radial_envelope=lambda r, r_max: e3nn.soft_envelope(r, r_max),
+                scan_layers=scan_layers,
+                reduce_layers=reduce_layers,
+            )(vectors, node_specie, senders, receivers)
+
+        return f
+
+    positions = jax.random.normal(jax.random.PRNGKey(0), (5, 3))
+    senders = jnp.array([0, 1, 2, 3, 4, 0, 2])
+    receivers = jnp.array([1, 2, 3, 4, 0, 3, 4])
+    args = (
+        positions[receivers] - positions[senders],
+        jnp.array([0, 1, 2, 1, 0]),
+        senders,
+        receivers,
+    )
+
+    w = model(False).init(jax.random.PRNGKey(1), *args)
+
+    # stack the parameters of the intermediate layers
+    w_scan = {}
+    for k, v in w.items():
+        if k.startswith("mace/layer_1/"):
+            w_scan[k.replace("mace/layer_1/", "mace/middle_layers/layer/")] = (
+                jax.tree_util.tree_map(
+                    lambda x, y: jnp.stack([x, y]),
+                    v,
+                    w[k.replace("mace/layer_1/", "mace/layer_2/")],
+                )
+            )
+        elif not k.startswith("mace/layer_2/"):
+            w_scan[k] = v
+
+    out = model(False).apply(w, *args)
+    out_scan = model(True).apply(w_scan, *args)
+    np.testing.assert_allclose(out.array, out_scan.array, atol=1e-5)
+
+    # the sum over the layers, with and without the accumulation in the scan carry
+    out_sum = model(False, "sum").apply(w, *args)
+    out_scan_sum = model(True, "sum").apply(w_scan, *args)
+    np.testing.assert_allclose(out_sum.array, out.array.sum(axis=1), atol=1e-5)
+    np.testing.assert_allclose(out_scan_sum.array, out.array.sum(axis=1), atol=1e-5)
+
+
 if __name__ == "__main__":
     test_mace()
     # test_symmetric_contraction()
@@ -0,0 +1,201 @@
+import e3nn_jax as e3nn
+import gin
+import jax
+import jax.numpy as jnp
+import jraph
+import numpy as np
+
+from mace_jax import data, tools
+from mace_jax.tools.gin_functions import parse_argv
+from mace_jax.tools.gin_model import bessel_basis, model, padded_apply
+
+
+def _bessel_basis(r, r_max):
+    return e3nn.bessel(r, 4, r_max)
+
+
+def _model(**kwargs):
+    return model(
+        **{
+            **dict(
+                r_max=3.0,
+                initialize_seed=0,
+                atomic_energies=np.array([1.0, -2.0, 0.5]),
+                avg_num_neighbors=2.0,
+                num_species=3,
+                num_interactions=2,
+                hidden_irreps="8x0e + 8x1o",
+                readout_mlp_irreps="4x0e",
+                max_ell=2,
+                correlation=2,
+                epsilon=None,
+                symmetric_tensor_product_basis=False,
+                off_diagonal=False,
+                radial_basis=_bessel_basis,
+            ),
+            **kwargs,
+        }
+    )
+
+
+def _inputs(num_nodes: int):
+    positions = np.asarray(jax.random.normal(jax.random.PRNGKey(0), (num_nodes, 3)))
+    senders = np.arange(num_nodes)
+    receivers = (senders + 1) % num_nodes
+    node_z = senders % 3
+    return positions[receivers] - positions[senders], node_z, senders, receivers
+
+
+def test_padded_apply():
+    apply_fn, params, _ = _model()
+
+    positions = np.asarray(jax.random.normal(jax.random.PRNGKey(0), (5, 3)))
+    node_z = np.array([0, 1, 2, 1, 0])
+    for senders, receivers in [
+        (np.array([0, 1, 2, 3, 4, 0, 2]), np.array([1, 2, 3, 4, 0, 3, 4])),
+        (np.zeros((0,), dtype=int), np.zeros((0,), dtype=int)),  # n_edge == 0
+    ]:
+        vectors = positions[receivers] - positions[senders]
+
+        out = apply_fn(params, vectors, node_z, senders, receivers)
+        out_padded = padded_apply(apply_fn, params, vectors, node_z, senders, receivers)
+        assert out_padded.shape == out.shape
+        np.testing.assert_allclose(out_padded, out, atol=1e-5)
+
+
+def test_model_normalization_options():
+    apply_fn, params, _ = _model(path_normalization="element")
+    out = apply_fn(params, *_inputs(5))
+
+    # build another model, then trace the first one again for a new shape
+    _model(path_normalization="path")
+    out_6 = apply_fn(params, *_inputs(6))
+    assert out_6.shape == (6,) and np.all(np.isfinite(out_6))
+    np.testing.assert_allclose(apply_fn(params, *_inputs(5)), out, atol=1e-6)
+
+    # the global options of e3nn are left untouched
+    assert e3nn.config("path_normalization") == "element"
+
+
+def test_model_gin_bindings():
+    def radial_mlp_inputs(params):
+        w = params[
+            "mace/layer_0/interaction_block/message_passing_convolution/"
+            "multi_layer_perceptron/linear_0"
+        ]["w"]
+        return w.shape[0]
+
+    try:
+        # the same arguments, but a binding read when the model is traced changes
+        gin.parse_config("bessel_basis.number = 8")
+        _, params, _ = _model(radial_basis=bessel_basis)
+        assert radial_mlp_inputs(params) == 8
+
+        gin.clear_config()
+        gin.parse_config("bessel_basis.number = 4")
+        _, params, _ = _model(radial_basis=bessel_basis)
+        assert radial_mlp_inputs(params) == 4
+    finally:
+        gin.clear_config()
+
+
+def _reference_energy_forces_stress(model, graph):
+    """Previous predictor, differentiating with respect to the positions and the cell."""
+
+    def energy_fn(positions, cell):
+        vectors = tools.get_edge_relative_vectors(
+            positions=positions,
+            senders=graph.senders,
+            receivers=graph.receivers,
+            shifts=graph.edges.shifts,
+            cell=cell,
+            n_edge=graph.n_edge,
+        )
+        node_energies = model(
+            vectors, graph.nodes.species, graph.senders, graph.receivers
+        )
+        return jnp.sum(node_energies), node_energies
+
+    (minus_forces, pseudo_stress), node_energies = jax.grad(
+        energy_fn, (0, 1), has_aux=True
+    )(graph.nodes.positions, graph.globals.cell)
+
+    det = jnp.linalg.det(graph.globals.cell)[:, None, None]
+    det = jnp.where(det > 0.0, det, 1.0)
+    stress_cell = jnp.transpose(pseudo_stress, (0, 2, 1)) @ graph.globals.cell
+    stress_forces = e3nn.scatter_sum(
+        jnp.einsum("iu,iv->iuv", minus_forces, graph.nodes.positions),
+        nel=graph.n_node,
+    )
+    stress = -1.0 / det * (stress_cell + stress_forces)
+    return {
+        "energy": e3nn.scatter_sum(node_energies, nel=graph.n_node),
+        "forces": -minus_forces,
+        "stress": stress,
+        "stress_cell": -1.0 / det * stress_cell,
+        "stress_forces": -1.0 / det * stress_forces,
+        "pressure": jnp.trace(stress, axis1=1, axis2=2),
+    }
+
+
+def test_predict_energy_forces_stress():
+    rng = np.random.default_rng(0)
+    graphs = []
+    for pbc, length in [(True, 3.0), (True, 3.5), (False, 10.0)]:
+        cell = length * np.eye(3) + 0.3 * rng.normal(size=(3, 3))
+        config = data.Configuration(
+            atomic_numbers=rng.integers(0, 3, 4),
+            positions=rng.uniform(0.0, length, (4, 3)),
+            cell=cell,
+            pbc=(pbc,) * 3,
+        )
+        graphs.append(data.graph_from_configuration(config, cutoff=2.5))
+    graph = jraph.pad_with_graphs(jraph.batch_np(graphs), 16, 256, 5)
+    assert np.any(graph.edges.shifts != 0)
+
+    a = jnp.array([0.3, -0.5, 0.8])
+
+    def model(vectors, node_z, senders, receivers):
+        # an anisotropic function of the edge vectors, for a nonzero stress
+        edge_energies = jnp.exp(-jnp.sum(vectors**2, axis=1)) * (1.0 + vectors @ a)
+        node_energies = jnp.zeros(node_z.shape, vectors.dtype)
+        return node_energies.at[receivers].add(edge_energies) + 0.1 * node_z
+
+    out = tools.predict_energy_forces_stress(model, graph)
+    ref = _reference_energy_forces_stress(model, graph)
+
+    assert set(out) == set(ref)
+    for key in ref:
+        np.testing.assert_allclose(out[key], ref[key], atol=1e-5, err_msg=key)
+
+
+def test_parse_argv(tmp_path):
+    config_file = str(tmp_path / "config.gin")
+    with open(config_file, "wt") as f:
+        f.write("flags.seed = 1\n")
+
+    try:
+        # the later argument wins
+        parse_argv(["run_train.py", config_file, "--flags.seed=2"])
+        assert gin.query_parameter("flags.seed") == 2
+        gin.clear_config()
+        parse_argv(["run_train.py", "--flags.seed", "2", config_file])
+        assert gin.query_parameter("flags.seed") == 1
+
+        # guessing whether the value is a string
+        for value, expected in [
+            ("None", None),
+            ("'quoted'", "quoted"),
+            ("unquoted", "unquoted"),
+            ("0.001", 0.001),
+        ]:
+            parse_argv(["run_train.py", f"--logs.name={value}"])
+            assert gin.query_parameter("logs.name") == expected
+        parse_argv(["run_train.py", "--model.radial_envelope=@identity"])
+        envelope = gin.query_parameter("model.radial_envelope")
+        assert envelope.selector == "identity"
+
+        # the config is not locked
+        gin.parse_config("flags.seed = 3")
+    finally:
+        gin.clear_config()